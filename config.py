@@ -1,2 +1,32 @@
+import os
+
 # Замените следующую строку на ваш токен API
 API_TOKEN = "YOUR_API_TOKEN"
+
+# Имена или полные пути к утилитам FFmpeg
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+
+# Пресет x264: чем быстрее пресет, тем меньше нагрузка на CPU при кодировании
+X264_PRESET = os.environ.get("X264_PRESET", "veryfast")
+
+# Кодировщик H.264 (libx264, h264_nvenc, h264_qsv, h264_vaapi); по умолчанию выбирается автоматически
+H264_ENCODER = os.environ.get("H264_ENCODER")
+VAAPI_DEVICE = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# Telegram ограничивает видеокружок одной минутой, более длинные видео обрезаются
+MAX_DURATION_SECONDS = 60
+
+# Кэш готовых видеокружков: file_unique_id исходного видео -> file_id видеокружка
+CACHE_FILENAME = os.environ.get("CACHE_FILENAME", "cache.json")
+CACHE_MAX_ENTRIES = 10000
+
+# Каталог для временных файлов; по умолчанию tmpfs в оперативной памяти
+TEMP_DIR = os.environ.get("BOT_TMPDIR", "/dev/shm")
+
+# Фрагментированный MP4 пишется за один проход без перезаписи moov (+faststart).
+# Включается FRAGMENTED_MP4=1, если клиенты Telegram корректно показывают такие видеокружки
+FRAGMENTED_MP4 = os.environ.get("FRAGMENTED_MP4") == "1"
+
+# Временные файлы старше этого срока считаются брошенными и удаляются при запуске бота
+TEMP_FILE_TTL_SECONDS = 1800
@@ -1,31 +1,322 @@
-from moviepy.editor import *
-from telegram import Update, InputMediaVideo
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext
+from mp4 import needs_seekable_input
+from config import (
+    X264_PRESET, H264_ENCODER, VAAPI_DEVICE, MAX_DURATION_SECONDS,
+    CACHE_FILENAME, CACHE_MAX_ENTRIES, TEMP_DIR, FRAGMENTED_MP4,
+    FFMPEG_BINARY, FFPROBE_BINARY, TEMP_FILE_TTL_SECONDS,
+)
+
+CIRCLE_SIZE = 360
+CPU_COUNT = os.cpu_count() or 2
+
+
+def find_binary(name):
+    path = shutil.which(name)
+    if path is None:
+        raise RuntimeError(f"{name} не найден: установите FFmpeg или укажите путь через FFMPEG_BINARY/FFPROBE_BINARY")
+    return path
+
+
+# Пути к ffmpeg и ffprobe определяются один раз при запуске
+FFMPEG = find_binary(FFMPEG_BINARY)
+FFPROBE = find_binary(FFPROBE_BINARY)
+
+# Масштабирование по меньшей стороне и обрезка по центру одним фильтром ffmpeg;
+# fast_bilinear быстрее bicubic по умолчанию, а разница на 360x360 незаметна
+VIDEO_FILTER = (
+    f"scale='if(gt(iw,ih),-2,{CIRCLE_SIZE})':'if(gt(iw,ih),{CIRCLE_SIZE},-2)':flags=fast_bilinear,"
+    f"crop={CIRCLE_SIZE}:{CIRCLE_SIZE}"
+)
+
+if FRAGMENTED_MP4:
+    MUXER_ARGS = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-frag_duration", "1000000"]
+else:
+    MUXER_ARGS = ["-movflags", "+faststart"]
+
+# Аппаратные кодировщики в порядке предпочтения, libx264 — запасной вариант
+HARDWARE_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi")
+
+
+def encoder_args(encoder):
+    """Возвращает аргументы ffmpeg до -i и после него для выбранного кодировщика."""
+    if encoder == "h264_nvenc":
+        return [], [
+            "-vf", VIDEO_FILTER,
+            "-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll",
+            "-rc", "vbr", "-b:v", "800k", "-maxrate", "1M", "-pix_fmt", "yuv420p",
+        ]
+    if encoder == "h264_qsv":
+        return [], [
+            "-vf", VIDEO_FILTER,
+            "-c:v", "h264_qsv", "-preset", "veryfast", "-b:v", "800k", "-maxrate", "1M",
+        ]
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE], [
+            "-vf", f"{VIDEO_FILTER},format=nv12,hwupload",
+            "-c:v", "h264_vaapi", "-b:v", "800k", "-maxrate", "1M",
+        ]
+    return [], [
+        "-vf", VIDEO_FILTER,
+        "-c:v", "libx264", "-preset", X264_PRESET, "-b:v", "800k",
+        "-profile:v", "baseline", "-level", "3.0", "-pix_fmt", "yuv420p",
+        # Для короткого ролика 360x360 больше четырёх потоков почти не ускоряют кодирование,
+        # а срезовая многопоточность не добавляет задержку на кадровый конвейер
+        "-threads", str(min(4, CPU_COUNT)),
+        "-x264-params", "sliced-threads=1:sync-lookahead=0",
+    ]
+
+
+def detect_h264_encoder():
+    # Наличие кодировщика в сборке ffmpeg не гарантирует наличие устройства,
+    # поэтому каждый кандидат проверяется пробным кодированием пары кадров
+    listed = subprocess.run(
+        [FFMPEG, "-hide_banner", "-encoders"], capture_output=True, text=True
+    ).stdout
+    for encoder in HARDWARE_ENCODERS:
+        if encoder not in listed:
+            continue
+        input_args, output_args = encoder_args(encoder)
+        result = subprocess.run(
+            [FFMPEG, "-v", "error", *input_args,
+             "-f", "lavfi", "-i", f"color=black:s={CIRCLE_SIZE}x{CIRCLE_SIZE}:d=0.1",
+             *output_args, "-f", "null", "-"],
+            capture_output=True,
+        )
+        if result.returncode == 0:
+            return encoder
+    return "libx264"
+
+
+H264_ENCODER = H264_ENCODER or detect_h264_encoder()
+
+
+def resolve_temp_dir(path):
+    # Файлы бота лежат в отдельном подкаталоге, чтобы очистка не задела чужие файлы в общем /tmp;
+    # если tmpfs недоступен или закрыт на запись, используется системный каталог
+    for base in (path, tempfile.gettempdir()):
+        directory = os.path.join(base, "circle-bot")
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(directory, os.W_OK):
+            return directory
+    raise RuntimeError(f"Нет доступного для записи каталога временных файлов: {path}")
+
+
+TEMP_DIR = resolve_temp_dir(TEMP_DIR)
+
+
+def make_temp_filename(file_unique_id):
+    prefix = "circle_" + re.sub(r"[^A-Za-z0-9_]", "_", file_unique_id) + "_"
+    with tempfile.NamedTemporaryFile(dir=TEMP_DIR, prefix=prefix, suffix=".mp4", delete=False) as temp_file:
+        return temp_file.name
+
+
+def try_remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        logging.warning("Не удалось удалить временный файл %s: %s", filename, error)
+
+
+async def cleanup_files(*filenames):
+    # Удаление выполняется в потоках, чтобы медленный диск не блокировал цикл событий
+    await asyncio.gather(*(asyncio.to_thread(try_remove, filename) for filename in filenames if filename))
+
+
+def remove_stale_temp_files():
+    # Файлы текущего процесса удаляются в finally, поэтому брошенными могут быть только
+    # файлы прошлого запуска, завершившегося аварийно; на tmpfs они занимали бы память бессрочно
+    deadline = time.time() - TEMP_FILE_TTL_SECONDS
+    for filename in glob.glob(os.path.join(TEMP_DIR, "circle_*.mp4")):
+        try:
+            if os.path.getmtime(filename) < deadline:
+                try_remove(filename)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            logging.warning("Не удалось проверить временный файл %s: %s", filename, error)
+
+
+# Ограничение числа одновременных кодирований, чтобы ffmpeg не занимал все ядра
+ENCODE_SLOTS = max(1, CPU_COUNT // 2)
+ENCODE_SEMAPHORE = asyncio.Semaphore(ENCODE_SLOTS)
+
+# Скачанное видео хранится в памяти до конца кодирования, поэтому число таких видео
+# тоже ограничено: по одному ожидающему на каждое кодирование
+MEDIA_SEMAPHORE = asyncio.Semaphore(2 * ENCODE_SLOTS)
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILENAME, encoding="utf-8") as cache_file:
+            return OrderedDict(json.load(cache_file))
+    except (OSError, ValueError, TypeError):
+        return OrderedDict()
+
+
+def save_cache(entries):
+    temp_filename = f"{CACHE_FILENAME}.tmp"
+    with open(temp_filename, "w", encoding="utf-8") as cache_file:
+        json.dump(entries, cache_file)
+    os.replace(temp_filename, CACHE_FILENAME)
+
+
+# Повторно присланное видео отправляется по file_id без скачивания и кодирования
+CACHE = load_cache()
+CACHE_LOCK = asyncio.Lock()
+
+# Одно и то же видео, присланное параллельно, кодируется один раз:
+# file_unique_id -> [блокировка, число обработчиков, использующих её]
+IN_FLIGHT = {}
+
+
+async def remember_video_note(file_unique_id, video_note_id):
+    CACHE[file_unique_id] = video_note_id
+    CACHE.move_to_end(file_unique_id)
+    while len(CACHE) > CACHE_MAX_ENTRIES:
+        CACHE.popitem(last=False)
+    async with CACHE_LOCK:
+        await asyncio.to_thread(save_cache, dict(CACHE))
+
+
+async def run_command(*args, input=None):
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate(input)
+    if process.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(args[0])} завершился с ошибкой: {stderr.decode(errors='replace')}")
+    return stdout.decode()
+
+
+async def probe_media(source, input=None):
+    """Возвращает длительность видео и кодек первой аудиодорожки (None, если звука нет)."""
+    output = await run_command(
+        FFPROBE, "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "format=duration:stream=codec_name", "-of", "json", source,
+        input=input,
+    )
+    info = json.loads(output)
+    streams = info.get("streams") or [{}]
+    return float(info.get("format", {}).get("duration", 0)), streams[0].get("codec_name")
+
 
 async def start(update: Update, context: CallbackContext):
     await update.message.reply_text("Отправьте мне видео, и я преобразую его в видеокружок.")
 
 async def process_video(update: Update, context: CallbackContext):
-    video_file = await context.bot.getFile(update.message.video.file_id)
-    await video_file.download_to_drive("input_video.mp4")
-
-    # Prеобразование видео в видеокружок
-    input_video = VideoFileClip("input_video.mp4")
-    w, h = input_video.size
-    circle_size = 360
-    aspect_ratio = float(w) / float(h)
-    
-    if w > h:
-        new_w = int(circle_size * aspect_ratio)
-        new_h = circle_size
+    video = update.message.video
+    entry = IN_FLIGHT.setdefault(video.file_unique_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        # Второй обработчик дождётся первого и отправит видеокружок из кэша
+        async with entry[0]:
+            await handle_video(update, context, video)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del IN_FLIGHT[video.file_unique_id]
+
+
+async def handle_video(update, context, video):
+    cached_id = CACHE.get(video.file_unique_id)
+    if cached_id:
+        try:
+            await context.bot.send_video_note(chat_id=update.message.chat_id, video_note=cached_id)
+            CACHE.move_to_end(video.file_unique_id)
+            return
+        except BadRequest as error:
+            # file_id действителен только для создавшего его бота (например, после смены токена),
+            # поэтому отвергнутая запись удаляется и видео кодируется заново. Остальные ошибки
+            # (запрет видеосообщений, недоступный чат) не связаны с file_id и повторятся при загрузке
+            if "file identifier" not in error.message.lower():
+                raise
+            CACHE.pop(video.file_unique_id, None)
+
+    await convert_and_send(update, context, video)
+
+
+async def convert_and_send(update, context, video):
+    # Имена временных файлов начинаются с file_unique_id и уникальны для каждого обработчика
+    output_filename = make_temp_filename(video.file_unique_id)
+    try:
+        async with MEDIA_SEMAPHORE:
+            video_file = await context.bot.getFile(video.file_id)
+            duration = await encode_video(video, await video_file.download_as_bytearray(), output_filename)
+
+        # Отправка видеокружка в чат
+        # Готовый файл читается целиком в потоке и передаётся как bytes, без повторных чтений при отправке
+        video_note = await asyncio.to_thread(Path(output_filename).read_bytes)
+        message = await context.bot.send_video_note(chat_id=update.message.chat_id, video_note=video_note, filename="video_note.mp4", duration=int(duration), length=CIRCLE_SIZE)
+        if message.video_note:
+            await remember_video_note(video.file_unique_id, message.video_note.file_id)
+    finally:
+        await cleanup_files(output_filename)
+
+
+async def encode_video(video, data, output_filename):
+    """Кодирует скачанное видео в output_filename и возвращает длительность видеокружка."""
+    # Входной файл создаётся, только если видео нельзя передать через stdin
+    input_filename = None
+    try:
+        # Видео передаётся ffmpeg через stdin; на диск пишется только MP4 с moov в конце,
+        # которому ffmpeg нужен произвольный доступ
+        if not needs_seekable_input(data):
+            try:
+                return await run_conversion(video, "pipe:0", data, output_filename)
+            except RuntimeError as error:
+                # Проверка заголовка ловит не всё (например, MP4 с плохим чередованием),
+                # поэтому неудачное чтение из pipe один раз повторяется из файла
+                logging.info("Не удалось обработать видео из pipe, повтор из файла: %s", error)
+        input_filename = make_temp_filename(video.file_unique_id)
+        await asyncio.to_thread(Path(input_filename).write_bytes, data)
+        return await run_conversion(video, input_filename, None, output_filename)
+    finally:
+        await cleanup_files(input_filename)
+
+
+async def run_conversion(video, source, stdin_data, output_filename):
+    # Длительность берётся из метаданных Telegram, ffprobe — если её нет
+    probed_duration, audio_codec = await probe_media(source, input=stdin_data)
+    duration = min(video.duration or probed_duration, MAX_DURATION_SECONDS)
+
+    # AAC из исходника копируется без перекодирования
+    if audio_codec == "aac":
+        audio_args = ["-c:a", "copy"]
     else:
-        new_w = circle_size
-        new_h = int(circle_size / aspect_ratio)
-        
-    resized_video = input_video.resize((new_w, new_h))
-    output_video = resized_video.crop(x_center=resized_video.w/2, y_center=resized_video.h/2, width=circle_size, height=circle_size)
-    output_video.write_videofile("output_video.mp4", codec="libx264", audio_codec="aac", bitrate="5M")
-
-    # Отправка видеокружка в чат
-    with open("output_video.mp4", "rb") as video:
-        await context.bot.send_video_note(chat_id=update.message.chat_id, video_note=video, duration=int(output_video.duration), length=circle_size)
+        audio_args = ["-c:a", "aac", "-b:a", "96k"]
+
+    # Преобразование видео в видеокружок
+    input_args, output_args = encoder_args(H264_ENCODER)
+    async with ENCODE_SEMAPHORE:
+        await run_command(
+            # -t перед -i останавливает чтение входа на границе обрезки
+            FFMPEG, "-y", *input_args, "-t", str(MAX_DURATION_SECONDS), "-i", source,
+            *output_args,
+            *MUXER_ARGS,
+            *audio_args,
+            output_filename,
+            input=stdin_data,
+        )
+    return duration
@@ -1,13 +1,29 @@
+import asyncio
 import logging
 from telegram import ForceReply, Update
 from telegram.ext import Application, Updater, CommandHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 from config import API_TOKEN
-from handlers import start, process_video
+from handlers import start, process_video, remove_stale_temp_files, H264_ENCODER
+
+async def post_init(application: Application):
+    # Однократная очистка при запуске, до обработки первого обновления
+    await asyncio.to_thread(remove_stale_temp_files)
 
 def main():
     logging.basicConfig(level=logging.INFO)
+    logging.info("Кодировщик H.264: %s", H264_ENCODER)
 
-    dp = Application.builder().token(API_TOKEN).build()
+    # Общий пул keep-alive соединений, чтобы параллельные запросы не открывали TLS заново
+    dp = (
+        Application.builder()
+        .token(API_TOKEN)
+        .post_init(post_init)
+        .concurrent_updates(True)
+        .get_updates_request(HTTPXRequest(connection_pool_size=32, pool_timeout=20.0))
+        .request(HTTPXRequest(connection_pool_size=64, read_timeout=60.0, write_timeout=60.0, media_write_timeout=60.0, connect_timeout=10.0))
+        .build()
+    )
 
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(MessageHandler(filters.VIDEO, process_video))
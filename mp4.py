@@ -0,0 +1,23 @@
+# Типы верхнеуровневых атомов, с которых начинаются MP4 и QuickTime (.mov) файлы;
+# у старых QuickTime-файлов атома ftyp может не быть
+TOP_LEVEL_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot"}
+
+
+def needs_seekable_input(data):
+    """Проверяет, лежит ли moov после mdat: такой MP4 нельзя прочитать из pipe."""
+    if bytes(data[4:8]) not in TOP_LEVEL_BOXES:
+        return False
+    offset = 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        box_type = data[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return False
+        if box_type == b"mdat":
+            return True
+        if size == 1:
+            size = int.from_bytes(data[offset + 8:offset + 16], "big")
+        if size < 8:
+            break
+        offset += size
+    return True
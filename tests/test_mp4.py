@@ -0,0 +1,45 @@
+import unittest
+
+from mp4 import needs_seekable_input
+
+
+def box(box_type, payload=b""):
+    return (8 + len(payload)).to_bytes(4, "big") + box_type + payload
+
+
+def large_box(box_type, payload=b""):
+    return (1).to_bytes(4, "big") + box_type + (16 + len(payload)).to_bytes(8, "big") + payload
+
+
+class NeedsSeekableInputTest(unittest.TestCase):
+    def test_moov_before_mdat_is_streamable(self):
+        data = box(b"ftyp", b"isom") + box(b"moov", b"\0" * 4) + box(b"mdat", b"\0" * 16)
+        self.assertFalse(needs_seekable_input(data))
+
+    def test_mdat_before_moov_needs_file(self):
+        data = box(b"ftyp", b"isom") + box(b"free") + box(b"mdat", b"\0" * 16) + box(b"moov")
+        self.assertTrue(needs_seekable_input(data))
+
+    def test_quicktime_without_ftyp(self):
+        self.assertTrue(needs_seekable_input(box(b"mdat", b"\0" * 16) + box(b"moov")))
+        self.assertFalse(needs_seekable_input(box(b"wide") + box(b"moov") + box(b"mdat")))
+
+    def test_64_bit_box_size(self):
+        data = box(b"ftyp", b"isom") + large_box(b"free", b"\0" * 8) + box(b"moov")
+        self.assertFalse(needs_seekable_input(data))
+
+    def test_truncated_or_corrupt_header_needs_file(self):
+        self.assertTrue(needs_seekable_input(box(b"ftyp", b"isom") + b"\0\0"))
+        self.assertTrue(needs_seekable_input(box(b"ftyp", b"isom") + (3).to_bytes(4, "big") + b"free"))
+
+    def test_other_containers_are_streamable(self):
+        self.assertFalse(needs_seekable_input(b"\x1aE\xdf\xa3" + b"\0" * 28))
+        self.assertFalse(needs_seekable_input(bytearray(b"")))
+
+    def test_accepts_bytearray(self):
+        data = bytearray(box(b"ftyp", b"isom") + box(b"mdat") + box(b"moov"))
+        self.assertTrue(needs_seekable_input(data))
+
+
+if __name__ == "__main__":
+    unittest.main()